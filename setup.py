@@ -15,4 +15,5 @@ setup(
     packages=find_packages("src"),
     package_dir={"": "src"},
     include_package_data=True,
+    extras_require={"fast": ["rapidfuzz"]},
 )
@@ -2,12 +2,163 @@ __author__ = "Yngve Mardal Moe"
 __email__ = "yngve.m.moe@gmail.com"
 
 
-import difflib
-from functools import wraps
+import heapq
+import sys
+from contextlib import contextmanager
+from functools import partial
+from operator import eq, itemgetter
+
+try:
+    from rapidfuzz import fuzz, process
+except ImportError:
+    fuzz = process = None
+
+
+# Maximum number of failed lookups whose suggestions are remembered
+_SIMILARITY_CACHE_SIZE = 128
+
+# Minimum number of names before rapidfuzz scores them all in one batch with cdist
+_BATCH_SCORING_THRESHOLD = 64
+
+
+def _similarity(matcher, item):
+    """Similarity between the query in ``matcher`` and the lowercased name in ``item``."""
+    matcher.set_seq2(item[1])
+    return matcher.ratio()
+
+
+def _rank_with_difflib(query, choices, limit):
+    """Rank the keys of ``choices`` by how similar their values are to ``query``."""
+    # Only needed when a lookup fails, so we don't import it up front
+    import difflib
+
+    # ratio is not symmetric, so the query stays the first sequence like in
+    # SequenceMatcher(None, query, name). We still reuse a single matcher.
+    matcher = difflib.SequenceMatcher(a=query)
+    if limit is None:
+        ranked = sorted(
+            choices.items(), key=partial(_similarity, matcher), reverse=True
+        )
+        return [name for name, _lower in ranked]
+    if limit <= 0:
+        return []
+
+    # real_quick_ratio and quick_ratio are cheap upper bounds for ratio. We visit the
+    # names in order of decreasing real_quick_ratio and only compute the ratio if the
+    # bounds show that the name can make it into the top ``limit`` names.
+    candidates = []
+    for index, (name, lower) in enumerate(choices.items()):
+        matcher.set_seq2(lower)
+        candidates.append((matcher.real_quick_ratio(), index, name, lower))
+    candidates.sort(key=itemgetter(0), reverse=True)
+
+    # Min-heap of (ratio, -index, name), so ties are broken by registration order
+    best = []
+    for upper_bound, index, name, lower in candidates:
+        if len(best) == limit and upper_bound < best[0][0]:
+            break
+        matcher.set_seq2(lower)
+        if len(best) == limit and matcher.quick_ratio() < best[0][0]:
+            continue
+
+        entry = (matcher.ratio(), -index, name)
+        if len(best) < limit:
+            heapq.heappush(best, entry)
+        else:
+            heapq.heappushpop(best, entry)
+
+    return [name for _ratio, _index, name in sorted(best, reverse=True)]
+
+
+def _rank_with_rapidfuzz(query, choices, limit):
+    """Rank the keys of ``choices`` by how similar their values are to ``query``."""
+    if limit is not None and limit > 0:
+        # Names more than twice as long (or short) as the query score at most
+        # 200 * min(m, n) / (m + n) < 200 / 3. If at least ``limit`` of the other names
+        # score higher than all these bounds, we don't need to score these names.
+        length = len(query)
+        near, far_bound = {}, None
+        for name, lower in choices.items():
+            if length <= 2 * len(lower) and len(lower) <= 2 * length:
+                near[name] = lower
+                continue
+            bound = 200 * min(length, len(lower)) / (length + len(lower))
+            if far_bound is None or bound > far_bound:
+                far_bound = bound
+
+        if far_bound is not None and len(near) >= limit:
+            ranked = _score_with_rapidfuzz(query, near, limit)
+            if ranked[-1][1] > far_bound:
+                return [name for name, _score in ranked]
+
+    return [name for name, _score in _score_with_rapidfuzz(query, choices, limit)]
+
+
+def _score_with_rapidfuzz(query, choices, limit):
+    """Return (key, score) pairs for the keys of ``choices`` with the highest scores."""
+    if len(choices) >= _BATCH_SCORING_THRESHOLD:
+        try:
+            scores = process.cdist(
+                [query],
+                list(choices.values()),
+                scorer=fuzz.ratio,
+                processor=None,
+                workers=1,
+            )[0]
+        except ImportError:
+            # cdist needs numpy, which is an optional dependency of rapidfuzz
+            pass
+        else:
+            scored = zip(choices, scores)
+            if limit is None:
+                return sorted(scored, key=itemgetter(1), reverse=True)
+            return heapq.nlargest(limit, scored, key=itemgetter(1))
+
+    # The names are already lowercased. rapidfuzz < 3 defaults to a processor that
+    # also strips punctuation, so we turn it off explicitly.
+    return [
+        (match, score)
+        for _lower, score, match in process.extract(
+            query, choices, scorer=fuzz.ratio, processor=None, limit=limit
+        )
+    ]
+
+
+def _init_subclass_hook(register, own_init_subclass, cls, *args, **kwargs):
+    """Hook that ``SubclassRegister.link_base`` installs on the linked base class.
+
+    ``link_base`` binds the register and the ``__init_subclass__`` that the base class
+    defined itself (if any) with ``functools.partial``, so subclasses of a base that is
+    linked to another register don't resolve to the wrong register.
+    """
+    if register._pending is not None:
+        register._pending.append(cls)
+        return _call_parent_init_subclass(
+            register, own_init_subclass, cls, args, kwargs
+        )
+
+    name = cls.__name__
+    if register.register.setdefault(name, cls) is not cls:
+        raise ValueError(
+            f"Cannot create two {register.class_type}s with the same name."
+        )
+    register._lower_keys[name] = name.lower()
+    register._available_cache = None
+    register._similarity_cache.clear()
+    return _call_parent_init_subclass(register, own_init_subclass, cls, args, kwargs)
+
 
+def _call_parent_init_subclass(register, own_init_subclass, cls, args, kwargs):
+    """Call the ``__init_subclass__`` that the register hook replaced."""
+    if own_init_subclass is not None:
+        return own_init_subclass.__get__(None, cls)(*args, **kwargs)
+    return super(register.linked_base, cls).__init_subclass__(*args, **kwargs)
 
-class NotInRegisterError(BaseException):
-    pass
+
+class NotInRegisterError(KeyError):
+    def __str__(self):
+        # KeyError shows the repr of its argument, which would escape the newlines
+        return str(self.args[0]) if self.args else ""
 
 
 class SubclassRegister:
@@ -16,6 +167,11 @@ class SubclassRegister:
     Use the `SubclassRegister.link` decorator to link a base class with
     the register.
 
+    Attributes
+    ----------
+    linked : bool
+        Whether the register is linked to a base class or not.
+
     Examples
     --------
     We create the register as any other class and link it to a base class using
@@ -75,6 +231,16 @@ class SubclassRegister:
     >>> register.available_classes
     ('Sedan', 'SUV')
 
+    The ``register`` attribute is the underlying dictionary, and changes to it are
+    picked up as well
+
+    >>> register.register['Roadster'] = type('Roadster', (), {})
+    >>> register.available_classes
+    ('Sedan', 'SUV', 'Roadster')
+    >>> del register.register['Roadster']
+    >>> register.available_classes
+    ('Sedan', 'SUV')
+
     But we can not overwrite already existing classes in the register
 
     >>> register['SUV'] = SUV
@@ -82,16 +248,23 @@ class SubclassRegister:
       ...
     ValueError: Cannot register two classes with the same name
 
-    If we use a name that is not in the register, we get an error and a list of the available classes sorted by similarity (using difflib)
+    If we use a name that is not in the register, we get an error and a list of the (at most ten) most similar available classes sorted by similarity (using rapidfuzz if it is installed and difflib otherwise)
 
-    >>> register['sedan'] # doctest: +IGNORE_EXCEPTION_DETAIL
+    >>> register['sedan']
     Traceback (most recent call last):
       ...
-    NotInRegisterError: sedan is not a valid name for a car.
+    subclass_register.subclass_register.NotInRegisterError: sedan is not a valid name for a car.
     Available cars are (in decreasing similarity):
        * Sedan
        * SUV
 
+    If we don't need the suggestions, we can use ``get``, which returns a default value instead
+
+    >>> print(register.get('sedan'))
+    None
+    >>> register.get('Sedan')
+    <class 'subclass_register.subclass_register.Sedan'>
+
     Similarly, if we try to access a class that we skipped, we get the same error.
 
     >>> register['SportsCar'] # doctest: +IGNORE_EXCEPTION_DETAIL
@@ -102,6 +275,48 @@ class SubclassRegister:
        * Sedan
        * SUV
 
+    The suggestions are ranked by similarity, so the closest names are listed first
+    also in larger registers
+
+    >>> layers = SubclassRegister('layer')
+    >>> for name in [
+    ...     'Tanh', 'Pool', 'Norm', 'Dense', 'Flatten', 'ReLU', 'Embed', 'GELU', 'SiLU',
+    ...     'Mish', 'Conv2dTranspose', 'Conv3dTranspose', 'Dropout', 'Softmax',
+    ... ]:
+    ...     layers[name] = type(name, (), {})
+    >>> layers['conv']
+    Traceback (most recent call last):
+      ...
+    subclass_register.subclass_register.NotInRegisterError: conv is not a valid name for a layer.
+    Available layers are (in decreasing similarity):
+       * Conv2dTranspose
+       * Conv3dTranspose
+       * Tanh
+       * Pool
+       * Norm
+       * Dense
+       * Flatten
+       * Dropout
+       * Softmax
+       * ReLU
+       ... and 4 more
+
+    Names that only differ in casing are listed first, followed by the other names
+
+    >>> vehicles = SubclassRegister('vehicle')
+    >>> for name in ['Zebra', 'Sedan', 'Sedans', 'Sedanx', 'SEDAN']:
+    ...     vehicles[name] = type(name, (), {})
+    >>> vehicles['sedan']
+    Traceback (most recent call last):
+      ...
+    subclass_register.subclass_register.NotInRegisterError: sedan is not a valid name for a vehicle.
+    Available vehicles are (in decreasing similarity):
+       * Sedan
+       * SEDAN
+       * Sedans
+       * Sedanx
+       * Zebra
+
     When we iterate over the register, we iterate over the class names
 
     >>> for car in register:
@@ -123,8 +338,125 @@ class SubclassRegister:
     ...     print(Car)
     <class 'subclass_register.subclass_register.Sedan'>
     <class 'subclass_register.subclass_register.SUV'>
+
+    Many classes can be added at once with ``register_many``, which uses the class
+    names as keys
+
+    >>> class Coupe:
+    ...     pass
+    >>> class Hatchback:
+    ...     pass
+    >>> register.register_many([Coupe, Hatchback])
+    >>> register.available_classes
+    ('Sedan', 'SUV', 'Coupe', 'Hatchback')
+
+    If any of the names are taken, or appear twice, no classes are added
+
+    >>> class Limousine:
+    ...     pass
+    >>> register.register_many([Limousine, Limousine, SUV])
+    Traceback (most recent call last):
+      ...
+    ValueError: Cannot register two classes with the same name: Limousine, SUV
+    >>> register.available_classes
+    ('Sedan', 'SUV', 'Coupe', 'Hatchback')
+
+    When many subclasses are created at once, e.g. when importing a large module,
+    we can collect them and add them to the register in one go with ``bulk_load``
+
+    >>> with register.bulk_load():
+    ...     class Pickup(BaseCar):
+    ...         pass
+    ...     class Van(BaseCar):
+    ...         pass
+    ...     'Pickup' in register
+    False
+    >>> register.available_classes
+    ('Sedan', 'SUV', 'Coupe', 'Hatchback', 'Pickup', 'Van')
+
+    Skipped classes are left out
+
+    >>> with register.bulk_load():
+    ...     @register.skip
+    ...     class Tractor(BaseCar):
+    ...         pass
+    ...     class Minivan(BaseCar):
+    ...         pass
+    >>> register.available_classes
+    ('Sedan', 'SUV', 'Coupe', 'Hatchback', 'Pickup', 'Van', 'Minivan')
+
+    If the body raises an exception, the exception propagates and no classes are added
+
+    >>> with register.bulk_load():
+    ...     class Buggy(BaseCar):
+    ...         pass
+    ...     raise RuntimeError('Could not import the buggy module')
+    Traceback (most recent call last):
+      ...
+    RuntimeError: Could not import the buggy module
+    >>> 'Buggy' in register
+    False
+
+    Name clashes are reported when the context exits, and then no classes are added
+
+    >>> with register.bulk_load():
+    ...     class Jeep(BaseCar):
+    ...         pass
+    ...     class Van(BaseCar):
+    ...         pass
+    Traceback (most recent call last):
+      ...
+    ValueError: Cannot register two classes with the same name: Van
+    >>> 'Jeep' in register
+    False
+
+    A subclass of a linked base class can itself be linked to another register. Its
+    subclasses are then added to both registers
+
+    >>> parts = SubclassRegister('part')
+    >>> @parts.link_base
+    ... class Part:
+    ...     pass
+    >>> wheels = SubclassRegister('wheel')
+    >>> @wheels.link_base
+    ... class Wheel(Part):
+    ...     pass
+    >>> class SnowWheel(Wheel):
+    ...     pass
+    >>> parts.available_classes
+    ('Wheel', 'SnowWheel')
+    >>> wheels.available_classes
+    ('SnowWheel',)
+
+    The linked base class can define its own ``__init_subclass__``, which is still
+    called with any keyword arguments
+
+    >>> tools = SubclassRegister('tool')
+    >>> @tools.link_base
+    ... class Tool:
+    ...     def __init_subclass__(cls, size=None, **kwargs):
+    ...         super().__init_subclass__(**kwargs)
+    ...         cls.size = size
+    >>> class Hammer(Tool, size=3):
+    ...     pass
+    >>> Hammer.size
+    3
+    >>> tools.available_classes
+    ('Hammer',)
     """
 
+    __slots__ = (
+        "class_type",
+        "linked_base",
+        "linked",
+        "register",
+        "_lower_keys",
+        "_available_cache",
+        "_similarity_cache",
+        "_pending",
+        "__weakref__",
+    )
+
     def __init__(self, class_type="class"):
         """Initiate a class register.
 
@@ -136,7 +468,12 @@ class SubclassRegister:
         """
         self.class_type = class_type
         self.linked_base = None
+        self.linked = False
         self.register = {}
+        self._lower_keys = {}
+        self._available_cache = None
+        self._similarity_cache = {}
+        self._pending = None
 
     def link_base(self, cls):
         """Link a base class to the register. Can be used as a decorator.
@@ -146,21 +483,14 @@ class SubclassRegister:
                 "Cannot link the same register with two different base classes"
             )
 
-        old_init_subclass = cls.__init_subclass__
-
-        @classmethod
-        @wraps(old_init_subclass)
-        def init_subclass(cls_, *args, **kwargs):
-            name = cls_.__name__
-            if name in self.register:
-                raise ValueError(
-                    f"Cannot create two {self.class_type}s with the same name."
-                )
-            self[name] = cls_
-            return old_init_subclass(*args, **kwargs)
-
         self.linked_base = cls
-        cls.__init_subclass__ = init_subclass
+        self.linked = True
+        hook = partial(
+            _init_subclass_hook, self, cls.__dict__.get("__init_subclass__")
+        )
+        hook.__name__ = "__init_subclass__"
+        hook.__qualname__ = f"{cls.__qualname__}.__init_subclass__"
+        cls.__init_subclass__ = classmethod(hook)
         return cls
 
     def skip(self, cls):
@@ -174,23 +504,68 @@ class SubclassRegister:
             raise ValueError(
                 f"{cls.__name__} is not a subclass of {self.linked_base.__name__}"
             )
-        del self[cls.__name__]
+        if self._pending is not None and cls in self._pending:
+            self._pending.remove(cls)
+        else:
+            del self[cls.__name__]
 
         return cls
 
-    @property
-    def available_classes(self):
-        """tuple[str]: Tuple of the classes in the register.
+    @contextmanager
+    def bulk_load(self):
+        """Context manager that adds all subclasses created within it to the register on exit.
+
+        The subclasses are added with a single call to ``register_many``, so name clashes
+        are not detected before the context is exited. If the body raises an exception,
+        none of the collected subclasses are added.
+        """
+        if self._pending is not None:
+            # Already bulk loading, the outermost context adds the classes
+            yield
+            return
+
+        self._pending = []
+        try:
+            yield
+        except BaseException:
+            self._pending = None
+            raise
+
+        pending, self._pending = self._pending, None
+        self.register_many(pending)
+
+    def register_many(self, classes):
+        """Add several classes to the register at once, using their names as keys.
+
+        No classes are added if any of the names are already in the register, or if
+        two of the classes have the same name.
         """
-        return tuple(self.register.keys())
+        new, clashes = {}, set()
+        for cls in classes:
+            name = sys.intern(cls.__name__)
+            if name in new or name in self.register:
+                clashes.add(name)
+            new[name] = cls
+        if clashes:
+            raise ValueError(
+                "Cannot register two classes with the same name: "
+                + ", ".join(sorted(clashes))
+            )
+
+        self.register.update(new)
+        self._lower_keys.update((name, name.lower()) for name in new)
+        self._available_cache = None
+        self._similarity_cache.clear()
 
     @property
-    def linked(self):
-        """bool: Whether the register is linked to a base class or not.
+    def available_classes(self):
+        """tuple[str]: Tuple of the classes in the register.
         """
-        if self.linked_base is None:
-            return False
-        return True
+        if self._available_cache is None or not self._matches_register(
+            self._available_cache
+        ):
+            self._available_cache = tuple(self.register)
+        return self._available_cache
 
     def items(self):
         """Iterate over class names and classes.
@@ -207,24 +582,76 @@ class SubclassRegister:
         """
         return self.register.keys()
 
-    def _get_items_by_similarity(self, class_name):
-        def get_similarity(class_name_):
-            return difflib.SequenceMatcher(
-                None, class_name.lower(), class_name_.lower()
-            ).ratio()
+    def get(self, class_name, default=None):
+        """Get a class from the register, or ``default`` if it is not in the register.
+
+        Unlike indexing, this does not compute the list of similar class names.
+        """
+        return self.register.get(class_name, default)
 
-        return sorted(self.register.keys(), key=get_similarity, reverse=True)
+    def _matches_register(self, names):
+        """Whether ``names`` are the names in ``self.register``, in the same order.
+
+        ``self.register`` is public and can be modified directly, so the caches
+        derived from it are checked with this before they are used.
+        """
+        return len(names) == len(self.register) and all(
+            map(eq, names, self.register)
+        )
+
+    def _sync_lower_keys(self):
+        """Rebuild the lowercased names if ``self.register`` was modified directly."""
+        if not self._matches_register(self._lower_keys):
+            self._lower_keys = {name: str(name).lower() for name in self.register}
+            self._similarity_cache.clear()
+
+    def _get_items_by_similarity(self, class_name, limit=10):
+        self._sync_lower_keys()
+        key = (str(class_name).lower(), limit)
+        if key not in self._similarity_cache:
+            if len(self._similarity_cache) >= _SIMILARITY_CACHE_SIZE:
+                # Dictionaries are ordered, so this evicts the oldest entry
+                del self._similarity_cache[next(iter(self._similarity_cache))]
+            self._similarity_cache[key] = self._compute_items_by_similarity(*key)
+        return self._similarity_cache[key]
+
+    def _compute_items_by_similarity(self, query, limit):
+        # Names that only differ in casing are the suggestions we want
+        exact_matches, others = [], {}
+        for name, lower in self._lower_keys.items():
+            if lower == query:
+                exact_matches.append(name)
+            else:
+                others[name] = lower
+
+        # Exact matches have the highest possible similarity, so we only need to rank
+        # the other names to fill up the remaining suggestions
+        remaining = None if limit is None else limit - len(exact_matches)
+        if remaining is not None and remaining <= 0:
+            return exact_matches[:limit]
+
+        if process is not None:
+            scored = _rank_with_rapidfuzz(query, others, remaining)
+        else:
+            # The real_quick_ratio bound in _rank_with_difflib already skips names
+            # whose length is too different from the query
+            scored = _rank_with_difflib(query, others, remaining)
+
+        return exact_matches + scored
 
     def _validate_class_in_register(self, class_name):
         if class_name not in self:
-            traceback = f"{class_name} is not a valid name for a {self.class_type}."
-            traceback = f"{traceback} \nAvailable {self.class_type}s are (in decreasing similarity):"
-
             sorted_items = self._get_items_by_similarity(class_name)
-            for available in sorted_items:
-                traceback = f"{traceback}\n   * {available}"
+            lines = [
+                f"{class_name} is not a valid name for a {self.class_type}.",
+                f"Available {self.class_type}s are (in decreasing similarity):",
+            ]
+            lines.extend(f"   * {available}" for available in sorted_items)
+            num_hidden = len(self.register) - len(sorted_items)
+            if num_hidden > 0:
+                lines.append(f"   ... and {num_hidden} more")
 
-            raise NotInRegisterError(traceback)
+            raise NotInRegisterError("\n".join(lines))
 
     def __contains__(self, class_name):
         """Check if a class name is in the register.
@@ -238,7 +665,15 @@ class SubclassRegister:
 
     def __getitem__(self, class_name):
         """Get a class from the register.
+
+        Registered string names are interned, so lookups with interned strings (see
+        ``sys.intern``) are slightly faster.
         """
+        try:
+            return self.register[class_name]
+        except KeyError:
+            pass
+        # Raise outside the except block to avoid chaining the bare KeyError
         self._validate_class_in_register(class_name)
         return self.register[class_name]
 
@@ -247,13 +682,27 @@ class SubclassRegister:
         """
         if name in self.register:
             raise ValueError(f"Cannot register two classes with the same name")
+        if type(name) is str:
+            # sys.intern rejects other types, including subclasses of str
+            name = sys.intern(name)
         self.register[name] = class_name
+        self._lower_keys[name] = str(name).lower()
+        self._available_cache = None
+        self._similarity_cache.clear()
 
     def __delitem__(self, class_name):
         """Delete a class from the register.
         """
+        try:
+            del self.register[class_name]
+        except KeyError:
+            pass
+        else:
+            self._lower_keys.pop(class_name, None)
+            self._available_cache = None
+            self._similarity_cache.clear()
+            return
         self._validate_class_in_register(class_name)
-        del self.register[class_name]
 
 
 if __name__ == "__main__":